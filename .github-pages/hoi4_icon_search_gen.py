@@ -2,48 +2,221 @@ import os
 import re
 import sys
 import json
+import pickle
 import subprocess
 import argparse
 import datetime
+import functools
+import itertools
+import hashlib
 import traceback
-from collections import defaultdict
-from wand import image  # also requires apt-get install libmagickwand-dev
-from wand.api import library
-
-BAD_FILES = []
-
-def convert_images(paths, updated_images=None):
-    global BAD_FILES
-    for x in paths:
-        for path, value in x.items():
-            frames = value[0].frames
-            if updated_images and not path in updated_images:
-                continue
-            try:
-                convert_image(path, frames)
-            except:
-                print("EXCEPTION with %s" % path)
-                ex_message = traceback.format_exc()
-                BAD_FILES.append((path, ex_message))
-                print(ex_message)
-
-def convert_image(path, frames):
+from html import escape
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image
+# keep ImageMagick from spawning its own threads inside the worker processes
+os.environ.setdefault('MAGICK_THREAD_LIMIT', '1')
+
+GFX_CACHE_DIR = '.gfxcache'
+GFX_CACHE_VERSION = 1
+PARALLEL_PARSE_MIN_FILES = 8
+CONVERT_CACHE_FILE = os.path.join(GFX_CACHE_DIR, 'convert_cache.json')
+GFX_CACHE_FILE = os.path.join(GFX_CACHE_DIR, 'gfx_cache.pickle')
+
+_TOKEN_RE = re.compile(r'@([A-Z_]+)')
+_QUOTED_PATH_RE = re.compile(r"'[^']+'")
+# one token of a spriteType body: a whole # comment or a single non-brace character
+_BODY = rb'(?:#[^\n]*\n|[^{}#])'
+# comments outside of blocks are matched (and skipped) as a whole so a commented-out
+# spriteType is never picked up; the lookaheads let the fields appear in any order
+_SPRITE_RE = re.compile(rb'#[^\n]*'
+                        rb'|spriteType\s*=\s*\{'
+                        rb'(?=' + _BODY + rb'*?(?<=\s)name\s*=\s*(?:"(?P<name>[^"]+)"|(?P<name_bare>[^\s"{}#]+)))'
+                        rb'(?=' + _BODY + rb'*?(?<=\s)texturefile\s*=\s*(?:"(?P<tex>[^"]+)"|(?P<tex_bare>[^\s"{}#]+)))'
+                        rb'(?:(?=' + _BODY + rb'*?(?<=\s)noOfFrames\s*=\s*(?P<frames>[0-9]+)))?'
+                        + _BODY + rb'*\}', re.IGNORECASE)
+
+def convert_images(sections, updated_images=None, verbose=False, max_workers=None, force=False):
+    # one task per texture, however many sprites use it; if sprites disagree on the
+    # frame count, the largest one wins (the result is then at least as narrow as a frame)
+    frames_by_path = {}
+    for gfx in sections:
+        for icon in gfx.values():
+            frames_by_path[icon.texturefile] = max(icon.frames, frames_by_path.get(icon.texturefile, 1))
+    # a missing source can't be converted, so it's left to main's missing-PNG report
+    # instead of starting a pool every run just to fail
+    frames_by_path = {path: frames for path, frames in frames_by_path.items() if _exists(path)}
+    convert_cache = ConvertCache()
+    # explicitly modified images are always reconverted, anything else only when its PNG is stale
+    # (or always, with --force); textures without a PNG yet are converted either way
+    if force:
+        tasks = [(path, frames, verbose) for path, frames in frames_by_path.items()]
+    elif updated_images:
+        tasks = [(path, frames, verbose) for path, frames in frames_by_path.items()
+                 if path in updated_images or not os.path.exists(_png_path(path))]
+    else:
+        tasks = [(path, frames, verbose) for path, frames in frames_by_path.items()
+                 if _needs_conversion(path, frames, convert_cache)]
+    bad_files = []
+    if not tasks:
+        # entries refreshed by _needs_conversion still need to be written back
+        convert_cache.save()
+        return bad_files
+    max_workers = max_workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        # only a couple of tasks per worker are queued at a time, topped up as they finish,
+        # so a full rebuild doesn't hold a future for every texture at once
+        pending_tasks = iter(tasks)
+        in_flight = {ex.submit(_convert_one, task) for task in itertools.islice(pending_tasks, 2 * max_workers)}
+        while in_flight:
+            # report failures as soon as they happen rather than in submission order
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, new_fname, sha1, ex_message = future.result()
+                if ex_message:
+                    print("EXCEPTION with %s" % path)
+                    bad_files.append((path, ex_message))
+                    print(ex_message)
+                elif new_fname:
+                    convert_cache.put(path, frames_by_path[path], sha1)
+                task = next(pending_tasks, None)
+                if task is not None:
+                    in_flight.add(ex.submit(_convert_one, task))
+    convert_cache.save()
+    bad_files.sort()
+    return bad_files
+
+class ConvertCache:
+    # source mtime, size, frames and content hash of every converted texture;
+    # only written back if an entry was added or refreshed during the run
+    __slots__ = ('entries', 'changed')
+
+    def __init__(self):
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(CONVERT_CACHE_FILE, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def put(self, path, frames, sha1):
+        st = os.stat(path)
+        self.entries[path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'frames': frames, 'sha1': sha1}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(GFX_CACHE_DIR, exist_ok=True)
+        tmp_file = CONVERT_CACHE_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, CONVERT_CACHE_FILE)
+        self.changed = False
+
+def _file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _png_is_up_to_date(path):
+    try:
+        return os.stat(_png_path(path)).st_mtime >= os.stat(path).st_mtime
+    except FileNotFoundError:
+        return False
+
+def _needs_conversion(path, frames, convert_cache):
+    # .gfxcache/ is gitignored, so on CI the cache only exists if the workflow restores it;
+    # without an entry, a PNG newer than its source is the best available hint
+    if not os.path.exists(_png_path(path)):
+        return True
+    entry = convert_cache.get(path)
+    if entry is None:
+        if not _png_is_up_to_date(path):
+            return True
+        # record the PNG that's already there, so later runs can still notice a new frame count
+        try:
+            convert_cache.put(path, frames, _file_sha1(path))
+        except OSError:
+            return True
+        return False
+    if entry['frames'] != frames:
+        return True
+    try:
+        st = os.stat(path)
+        if entry.get('mtime_ns') == st.st_mtime_ns and entry['size'] == st.st_size:
+            return False
+        if entry['size'] != st.st_size or entry['sha1'] != _file_sha1(path):
+            return True
+    except OSError:
+        return True
+    # same content under a new mtime (e.g. a fresh checkout), so the next run can skip the hash
+    convert_cache.put(path, frames, entry['sha1'])
+    return False
+
+def _convert_one(task):
+    path, frames, verbose = task
+    try:
+        new_fname = convert_image(path, frames, verbose)
+        # hashed here so the parent doesn't re-read every converted source while draining results
+        return (path, new_fname, _file_sha1(path) if new_fname else None, None)
+    except:
+        return (path, None, None, traceback.format_exc())
+
+def convert_image(path, frames, verbose=False):
     if os.path.exists(path):
         fname = os.path.splitext(path)[0]
-        with image.Image(filename=path) as img:
-            if frames > 1:
-                print("%s has %d frames, cropping..." % (fname, frames))
-                img.crop(0, 0, width=img.width // frames, height=img.height)
-            library.MagickSetCompressionQuality(img.wand, 00)
-            new_fname = fname + '.png'
-            print("Saving %s..." % (new_fname))
-            img.save(filename=new_fname)
-            return new_fname
+        new_fname = fname + '.png'
+        try:
+            with Image.open(path) as img:
+                if frames > 1:
+                    if verbose:
+                        print(f"{fname} has {frames} frames, cropping...")
+                    img = img.crop((0, 0, img.width // frames, img.height))
+                img = _to_palette_if_lossless(img)
+                if verbose:
+                    print(f"Saving {new_fname}...")
+                img.save(new_fname, 'PNG', compress_level=1)
+        except (OSError, NotImplementedError):
+            # Pillow can't decode some DDS variants, ImageMagick can. MagickWand is only
+            # loaded by the workers that need it, once per process
+            from wand import image  # also requires apt-get install libmagickwand-dev
+            with image.Image(filename=path) as img:
+                if frames > 1:
+                    if verbose:
+                        print(f"{fname} has {frames} frames, cropping...")
+                    img.crop(0, 0, width=img.width // frames, height=img.height)
+                # zlib level 1 like the Pillow path, no per-row filter search, and no
+                # timestamp/metadata chunks so unchanged textures produce identical files
+                img.options['png:compression-level'] = '1'
+                img.options['png:compression-filter'] = '0'
+                img.options['png:exclude-chunks'] = 'all'
+                if verbose:
+                    print(f"Saving {new_fname}...")
+                img.save(filename=new_fname)
+        return new_fname
     else:
         print("%s does not exist!" % path)
         return None
 
+def _to_palette_if_lossless(img):
+    # flat icons fit into an 8-bit palette and come out several times smaller; anything
+    # with real alpha or more than 256 colors is left alone so the PNG stays lossless
+    if img.mode == 'RGBA' and img.getextrema()[3] == (255, 255):
+        img = img.convert('RGB')
+    if img.mode != 'RGB':
+        return img
+    colors = img.getcolors(256)
+    if colors is None:
+        return img
+    # median cut gives every color its own palette entry when there are few enough of them
+    return img.quantize(colors=len(colors), method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+
 class SpriteType:
+    __slots__ = ('name', 'texturefile', 'frames')
+
     def __init__(self, name, texturefile, frames):
         self.name = name
         self.texturefile = texturefile
@@ -55,145 +228,301 @@ class SpriteType:
     def __repr__(self):
         return self.name
 
-def read_gfx(gfx_paths):
+def _iter_gfx(root):
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith('.gfx') and entry.is_file():
+                    yield entry.path
+
+@functools.lru_cache(maxsize=None)
+def _list_gfx(root):
+    # several sections are often pointed at the same folder, so each one is only walked once;
+    # sorted so that name collisions resolve the same way on every run
+    return tuple(sorted(_iter_gfx(root)))
+
+def read_gfx(gfx_paths, gfx_cache):
     gfx = {}
-    gfx_files = defaultdict(list)
+    gfx_paths_expanded = []
+    for path in gfx_paths:
+        if os.path.isdir(path):
+            gfx_paths_expanded.extend(_list_gfx(path))
+        else:
+            gfx_paths_expanded.append(path)
+    gfx_paths = gfx_paths_expanded
+    if not gfx_paths:
+        return gfx
+
+    # unchanged files come from their cache entries, only the rest gets parsed
+    parsed = {}
+    to_parse = []
+    for path in gfx_paths:
+        if path in parsed:
+            continue
+        cached = gfx_cache.get(path)
+        if cached is None:
+            to_parse.append(path)
+            parsed[path] = None
+        else:
+            parsed[path] = cached
+
+    if len(to_parse) < PARALLEL_PARSE_MIN_FILES:
+        # a handful of files parses faster than a process pool starts up
+        for path, local_gfx in zip(to_parse, map(_parse_one_gfx, to_parse)):
+            parsed[path] = local_gfx
+            gfx_cache.put(path, local_gfx)
+    else:
+        with ProcessPoolExecutor() as ex:
+            for path, local_gfx in zip(to_parse, ex.map(_parse_one_gfx, to_parse, chunksize=4)):
+                parsed[path] = local_gfx
+                gfx_cache.put(path, local_gfx)
+
+    # merged in input order, so later files still win on name collisions
     for path in gfx_paths:
-        path = os.path.join(path)
-        with open(path, 'r') as f:
-            file_contents = f.read()
-        file_contents = re.sub(r'#.*\n', ' ', file_contents, re.IGNORECASE)
-        file_contents = file_contents.replace('\n', ' ')
-        spriteTypes = re.findall(r'spriteType\s*=\s*\{[^\{\}]*?\}', file_contents, re.IGNORECASE)
-        for spriteType in spriteTypes:
-            name = ''
-            texturefile = ''
-            noOfFrames = 1
-            match = re.search(r'\s+name\s*=\s*\"(.+?)\"', spriteType, re.IGNORECASE)
-            if match:
-                name = match.group(1)
-            match = re.search(r'\s+texturefile\s*=\s*\"(.+?)\"', spriteType, re.IGNORECASE)
-            if match:
-                texturefile = os.path.normpath(match.group(1))
-            match = re.search(r'\s+noOfFrames\s*=\s*([0-9]+?)', spriteType, re.IGNORECASE)
-            if match:
-                noOfFrames = int(match.group(1))
-            if name and texturefile:
-                st = SpriteType(name, texturefile, noOfFrames)
-                gfx[name] = st
-                gfx_files[texturefile].append(st)
-
-    return (gfx, gfx_files)
-
-def generate_icons_section(icons_dict, path_dicts, remove_str = None):
-    global BAD_FILES
+        gfx.update(parsed[path])
+    # textures are resolved here rather than cached with the parse, since what they resolve to
+    # depends on the files on disk, not on the gfx file
+    for icon in gfx.values():
+        if not _exists(icon.texturefile):
+            # the game runs on Windows, so gfx files don't always match the texture's case; the
+            # real name is needed on any filesystem, since the pages host is case-sensitive
+            icon.texturefile = _find_case_insensitive(icon.texturefile) or icon.texturefile
+        # sprites from different files (and workers) sharing a texture end up sharing one string,
+        # which keeps memory down and makes the texture dict/set lookups later on identity hits
+        icon.texturefile = sys.intern(icon.texturefile)
+    return gfx
+
+class GfxCache:
+    # parsed sprites of every gfx file, keyed on the file's mtime and size; one file on disk,
+    # loaded once, shared by all sections and only written back if something was parsed
+    __slots__ = ('entries', 'changed')
+
+    def __init__(self):
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(GFX_CACHE_FILE, 'rb') as f:
+                version, entries = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            return
+        if version == GFX_CACHE_VERSION:
+            self.entries = entries
+
+    def get(self, path):
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            return None
+        return {name: SpriteType(name, texturefile, frames) for name, texturefile, frames in entry[2]}
+
+    def put(self, path, gfx):
+        st = os.stat(path)
+        self.entries[path] = (st.st_mtime_ns, st.st_size,
+                              [(sprite.name, sprite.texturefile, sprite.frames) for sprite in gfx.values()])
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(GFX_CACHE_DIR, exist_ok=True)
+        tmp_file = GFX_CACHE_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((GFX_CACHE_VERSION, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, GFX_CACHE_FILE)
+        self.changed = False
+
+def _parse_one_gfx(path):
+    gfx = {}
+    with open(path, 'rb') as f:
+        file_contents = f.read()
+    for match in _SPRITE_RE.finditer(file_contents):
+        if match[0].startswith(b'#'):
+            continue
+        name = (match['name'] or match['name_bare']).decode('utf-8', 'replace')
+        texturefile = os.path.normpath((match['tex'] or match['tex_bare']).decode('utf-8', 'replace'))
+        noOfFrames = int(match['frames'] or 1)
+        st = SpriteType(name, texturefile, noOfFrames)
+        gfx[name] = st
+
+    return gfx
+
+@functools.lru_cache(maxsize=None)
+def _dir_index(d):
+    try:
+        return {name.lower(): name for name in os.listdir(d)}
+    except OSError:
+        return {}
+
+@functools.lru_cache(maxsize=None)
+def _dir_names(d):
+    try:
+        return frozenset(os.listdir(d))
+    except OSError:
+        return frozenset()
+
+def _exists(path):
+    # sprites mostly share a few texture folders, so one listing per folder beats a stat per texture;
+    # the match is exact-case on every filesystem, so miscased paths always get resolved
+    parent, name = os.path.split(path)
+    if not name or name in (os.curdir, os.pardir):
+        # roots and '..' aren't entries of any listing
+        return os.path.isdir(path)
+    return name in _dir_names(parent or '.')
+
+@functools.lru_cache(maxsize=None)
+def _find_case_insensitive(path):
+    parent, name = os.path.split(path)
+    # only fall back to listing directories for segments that aren't already known to exist
+    if parent and not _exists(parent):
+        parent = _find_case_insensitive(parent)
+        if parent is None:
+            return None
+    real = _dir_index(parent or '.').get(name.lower())
+    return os.path.join(parent, real) if real else None
+
+def find_existing_pngs(sections):
+    # one directory listing per texture folder instead of one stat per texture
+    existing = set()
+    for d in {os.path.dirname(icon.texturefile) for gfx in sections for icon in gfx.values()}:
+        try:
+            with os.scandir(d or '.') as it:
+                existing.update(os.path.join(d, entry.name) for entry in it if entry.name.endswith('.png'))
+        except OSError:
+            pass
+    return existing
+
+@functools.lru_cache(maxsize=None)
+def _png_path(texturefile):
+    # many sprites share one texture, so the .png path is only built once per texture
+    return os.path.splitext(texturefile)[0] + '.png'
+
+def generate_icons_section(icons_dict, existing_pngs, remove_str = None):
     icon_entries = []
     icons_num = 0
 
     for key, icon in icons_dict.items():
         name = icon.name
         path = icon.texturefile
-        img_src = os.path.splitext(path)[0] + '.png'
-        if not os.path.exists(img_src):
-            try:
-                frames = icon.frames
-                convert_image(path, frames)
-            except:
-                print("EXCEPTION with %s" % path)
-                ex_message = traceback.format_exc()
-                BAD_FILES.append((path, ex_message))
-                print(ex_message)
-        if os.path.exists(img_src):
+        img_src = _png_path(path)
+        if img_src in existing_pngs:
             if remove_str:
-                name = name.replace(remove_str, "")
+                name = name.removeprefix(remove_str)
             icons_num += 1
-            icon_entries.append('''
-          <div data-clipboard-text="%s" data-search-text="%s" title="%s" class="icon">
-            <img src="%s" alt="%s">
-          </div>
-        ''' % (name, name, name, img_src, name))
+            icon_entries.append((name, img_src))
     return (icon_entries, icons_num)
 
-def generate_html(goals, ideas, texticons, events, news_events, agencies, decisions, decisions_cat, decisions_pics, path_dicts, title, favicon):
+def _icon_entries(icons):
+    for name, img_src in icons:
+        name = escape(name)
+        yield f'\n<div data-clipboard-text="{name}" data-search-text="{name}" title="{name}" class="icon"><img src="{escape(img_src)}" alt="{name}"></div>'
+
+def generate_html(goals, ideas, texticons, events, news_events, agencies, decisions, decisions_cat, decisions_pics, existing_pngs, title, favicon):
     with open(os.path.join('.github-pages', 'index.template'), 'r') as f:
         html = f.read()
+    subs = {}
+    sections = {}
 
-    goal_entries, goals_num = generate_icons_section(goals, path_dicts)
+    goal_entries, goals_num = generate_icons_section(goals, existing_pngs)
 
-    html = html.replace('@GOALS_ICONS', ''.join(goal_entries))
-    html = html.replace('@GOALS_NUM', str(goals_num))
+    sections['GOALS_ICONS'] = goal_entries
+    subs['GOALS_NUM'] = str(goals_num)
 
-    idea_entries, ideas_num = generate_icons_section(ideas, path_dicts, "GFX_idea_")
+    idea_entries, ideas_num = generate_icons_section(ideas, existing_pngs, "GFX_idea_")
 
-    html = html.replace('@IDEAS_ICONS', ''.join(idea_entries))
-    html = html.replace('@IDEAS_NUM', str(ideas_num))
+    sections['IDEAS_ICONS'] = idea_entries
+    subs['IDEAS_NUM'] = str(ideas_num)
 
-    texticons_entries, texticons_num = generate_icons_section(texticons, path_dicts)
+    texticons_entries, texticons_num = generate_icons_section(texticons, existing_pngs)
 
-    html = html.replace('@TEXTICONS_ICONS', ''.join(texticons_entries))
-    html = html.replace('@TEXTICONS_NUM', str(texticons_num))
+    sections['TEXTICONS_ICONS'] = texticons_entries
+    subs['TEXTICONS_NUM'] = str(texticons_num)
 
-    events_entries, events_num = generate_icons_section(events, path_dicts)
+    events_entries, events_num = generate_icons_section(events, existing_pngs)
 
-    html = html.replace('@EVENTS_ICONS', ''.join(events_entries))
-    html = html.replace('@EVENTS_NUM', str(events_num))
+    sections['EVENTS_ICONS'] = events_entries
+    subs['EVENTS_NUM'] = str(events_num)
 
-    news_events_entries, news_events_num = generate_icons_section(news_events, path_dicts)
+    news_events_entries, news_events_num = generate_icons_section(news_events, existing_pngs)
 
-    html = html.replace('@NEWSEVENTS_ICONS', ''.join(news_events_entries))
-    html = html.replace('@NEWSEVENTS_NUM', str(news_events_num))
+    sections['NEWSEVENTS_ICONS'] = news_events_entries
+    subs['NEWSEVENTS_NUM'] = str(news_events_num)
 
-    agencies_entries, agencies_num = generate_icons_section(agencies, path_dicts)
+    agencies_entries, agencies_num = generate_icons_section(agencies, existing_pngs)
 
-    html = html.replace('@AGENCIES_ICONS', ''.join(agencies_entries))
-    html = html.replace('@AGENCIES_NUM', str(agencies_num))
+    sections['AGENCIES_ICONS'] = agencies_entries
+    subs['AGENCIES_NUM'] = str(agencies_num)
 
-    decisions_entries, decisions_num = generate_icons_section(decisions, path_dicts)
+    decisions_entries, decisions_num = generate_icons_section(decisions, existing_pngs)
 
-    html = html.replace('@DECISIONS_ICONS', ''.join(decisions_entries))
-    html = html.replace('@DECISIONS_NUM', str(decisions_num))
+    sections['DECISIONS_ICONS'] = decisions_entries
+    subs['DECISIONS_NUM'] = str(decisions_num)
 
-    decisions_cat_entries, decisions_cat_num = generate_icons_section(decisions_cat, path_dicts)
+    decisions_cat_entries, decisions_cat_num = generate_icons_section(decisions_cat, existing_pngs)
 
-    html = html.replace('@DECISIONSCAT_ICONS', ''.join(decisions_cat_entries))
-    html = html.replace('@DECISIONSCAT_NUM', str(decisions_cat_num))
+    sections['DECISIONSCAT_ICONS'] = decisions_cat_entries
+    subs['DECISIONSCAT_NUM'] = str(decisions_cat_num)
 
-    decisions_pics_entries, decisions_pics_num = generate_icons_section(decisions_pics, path_dicts)
+    decisions_pics_entries, decisions_pics_num = generate_icons_section(decisions_pics, existing_pngs)
 
-    html = html.replace('@DECISIONSPICS_ICONS', ''.join(decisions_pics_entries))
-    html = html.replace('@DECISIONSPICS_NUM', str(decisions_pics_num))
+    sections['DECISIONSPICS_ICONS'] = decisions_pics_entries
+    subs['DECISIONSPICS_NUM'] = str(decisions_pics_num)
 
-    html = html.replace('@TITLE', title)
+    subs['TITLE'] = title
     favicon = favicon if favicon else ""
-    html = html.replace('@FAVICON', favicon)
-    #html = html.replace('@UPDATE_DATE', str(datetime.datetime.utcnow())) # moved to the action itself so it can only be updated on push
-
-    with open('index.html', 'w') as f:
-        f.write(html)
+    subs['FAVICON'] = favicon
+    #subs['UPDATE_DATE'] = str(datetime.datetime.utcnow()) # moved to the action itself so it can only be updated on push
+
+    # unknown tokens (e.g. @UPDATE_DATE) are left in place
+    # split() alternates literal text and token names; icon sections are streamed into the file
+    parts = _TOKEN_RE.split(html)
+    with open('index.html', 'w', buffering=1 << 20) as f:
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                f.write(part)
+            elif part in sections:
+                f.writelines(_icon_entries(sections[part]))
+            else:
+                f.write(subs.get(part, '@' + part))
 
 
 def main():
-    global BAD_FILES
     print("Starting hoi4_icon_search_gen...")
     args = setup_cli_arguments()
     if args.modified_images:
-        args.modified_images = set(args.modified_images)
+        args.modified_images = frozenset(args.modified_images)
         print(args.modified_images)
-    goals, goals_files = read_gfx(args.goals)
-    ideas, ideas_files = read_gfx(args.ideas)
-    texticons, texticons_files = read_gfx(args.texticons)
-    events, events_files = read_gfx(args.events)
-    news_events, news_events_files = read_gfx(args.news_events)
-    agencies, agencies_files = read_gfx(args.agencies)
-    decisions, decisions_files = read_gfx(args.decisions)
-    decisions_cat, decisions_cat_files = read_gfx(args.decisions_cat)
-    decisions_pics, decisions_pics_files = read_gfx(args.decisions_pics)
-    path_dicts = [goals_files, ideas_files, texticons_files, events_files, news_events_files, agencies_files, decisions_files, decisions_cat_files, decisions_pics_files]
-    convert_images(path_dicts,
-                   args.modified_images)
-    generate_html(goals, ideas, texticons, events, news_events, agencies, decisions, decisions_cat, decisions_pics, path_dicts, args.title, args.favicon)
+    gfx_cache = GfxCache()
+    goals = read_gfx(args.goals, gfx_cache)
+    ideas = read_gfx(args.ideas, gfx_cache)
+    texticons = read_gfx(args.texticons, gfx_cache)
+    events = read_gfx(args.events, gfx_cache)
+    news_events = read_gfx(args.news_events, gfx_cache)
+    agencies = read_gfx(args.agencies, gfx_cache)
+    decisions = read_gfx(args.decisions, gfx_cache)
+    decisions_cat = read_gfx(args.decisions_cat, gfx_cache)
+    decisions_pics = read_gfx(args.decisions_pics, gfx_cache)
+    gfx_cache.save()
+    sections = [goals, ideas, texticons, events, news_events, agencies, decisions, decisions_cat, decisions_pics]
+    bad_files = []
+    bad_files += convert_images(sections,
+                                args.modified_images, args.verbose, args.jobs, args.force)
+    existing_pngs = find_existing_pngs(sections)
+    # failed conversions were already reported with their traceback
+    failed = {path for path, _ in bad_files}
+    for path in sorted({icon.texturefile for gfx in sections for icon in gfx.values()}):
+        if not _png_path(path) in existing_pngs and path not in failed:
+            bad_files.append((path, "No PNG after conversion"))
+    generate_html(goals, ideas, texticons, events, news_events, agencies, decisions, decisions_cat, decisions_pics, existing_pngs, args.title, args.favicon)
     print("The following files had exceptions:")
-    for f in BAD_FILES:
+    for f in bad_files:
         print(f[0])
         print(f[1])
 
@@ -201,31 +530,37 @@ def setup_cli_arguments():
     parser = argparse.ArgumentParser(
         description='')
     parser.add_argument('--goals', nargs='*',
-                        help='Paths to goals (national focus) interface gfx files', required=False)
+                        help='Paths to goals (national focus) interface gfx files or directories', required=False)
     parser.add_argument('--ideas', nargs='*',
-                        help='Paths to ideas interface gfx files', required=False)
+                        help='Paths to ideas interface gfx files or directories', required=False)
     parser.add_argument('--texticons', nargs='*',
-                        help='Paths to texticons interface gfx files', required=False)
+                        help='Paths to texticons interface gfx files or directories', required=False)
     parser.add_argument('--events', nargs='*',
-                        help='Paths to events interface gfx files', required=False)
+                        help='Paths to events interface gfx files or directories', required=False)
     parser.add_argument('--news-events', nargs='*', dest="news_events",
-                        help='Paths to news events interface gfx files', required=False)
+                        help='Paths to news events interface gfx files or directories', required=False)
     parser.add_argument('--agencies', nargs='*',
-                        help='Paths to agencies interface gfx files', required=False)
+                        help='Paths to agencies interface gfx files or directories', required=False)
     parser.add_argument('--decisions', nargs='*',
-                        help='Paths to decisions interface gfx files', required=False)
+                        help='Paths to decisions interface gfx files or directories', required=False)
     parser.add_argument('--decisions-cat', nargs='*', dest="decisions_cat",
-                        help='Paths to decisions category interface gfx files', required=False)
+                        help='Paths to decisions category interface gfx files or directories', required=False)
     parser.add_argument('--decisions-pics', nargs='*', dest="decisions_pics",
-                        help='Paths to decision category picture interface gfx files', required=False)
+                        help='Paths to decision category picture interface gfx files or directories', required=False)
     parser.add_argument('--title',
                         help='Webpage title', required=True)
     parser.add_argument('--favicon',
                         help='Path to webpage favicon', required=False)
+    parser.add_argument('--jobs', type=int,
+                        help='Number of image conversion processes (defaults to the number of CPUs)', required=False)
+    parser.add_argument('--force', action='store_true',
+                        help='Reconvert every image, even if its PNG is up to date', required=False)
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print every converted image', required=False)
     parser.add_argument('--modified-images', nargs='*',
-                        help='Paths to modified image files (If not set, will convert all images)', dest="modified_images", required=False)
+                        help='Paths to modified image files to reconvert (If not set, only images whose PNG is missing or out of date are converted; use --force to convert all images)', dest="modified_images", required=False)
     parser.add_argument('--modified-images-str', nargs='?',
-                        help='Paths to modified image files (If not set, will convert all images)', dest="modified_images_str", required=False)
+                        help='Paths to modified image files to reconvert (If not set, only images whose PNG is missing or out of date are converted; use --force to convert all images)', dest="modified_images_str", required=False)
 
     args = parser.parse_args()
     args.goals = [os.path.normpath(x) for x in args.goals] if args.goals else []
@@ -238,7 +573,7 @@ def setup_cli_arguments():
     args.decisions_cat = [os.path.normpath(x) for x in args.decisions_cat] if args.decisions_cat else []
     args.decisions_pics = [os.path.normpath(x) for x in args.decisions_pics] if args.decisions_pics else []
     if args.modified_images_str:
-        args.modified_images_str = [x.replace("'", "") for x in re.findall(r"'[^']+'", args.modified_images_str)]
+        args.modified_images_str = [x.replace("'", "") for x in _QUOTED_PATH_RE.findall(args.modified_images_str)]
         args.modified_images = args.modified_images_str
     if args.modified_images:
         args.modified_images = [os.path.normpath(